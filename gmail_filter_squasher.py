@@ -1,7 +1,12 @@
+import argparse
 from collections import defaultdict
-import json
+import datetime
 import logging
+import math
 import os.path
+import random
+import time
+from typing import Callable, Iterator
 
 from google.auth.exceptions import GoogleAuthError
 from google.auth.transport.requests import Request
@@ -9,21 +14,21 @@ from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build, Resource
 from googleapiclient.errors import HttpError
+from googleapiclient.http import BatchHttpRequest, HttpRequest
+import httplib2
+import orjson
 
 
 # ------------------------------
 # VARIABLES
 # ------------------------------
 
-# My recommendation would be to run it at least once in debug mode (DEBUG=True) to
+# The debug and verbosity modes are chosen when running the script, see `--help`.
+# My recommendation would be to run it at least once in debug mode (the default) to
 # assert what filters will be squashed.
 # Do note that no changes will be performed into Gmail until debug mode is manually
-# deactivated (DEBUG=False).
+# deactivated (`--commit`).
 
-# Debug mode. If True, no changes will be applied into Gmail
-DEBUG = True
-# Verbosity mode. If True, extra logs will be output
-VERBOSE_MODE = False
 # File with the credentials to use
 CREDENTIALS_FILE = "credentials.json"
 
@@ -40,35 +45,171 @@ logger = logging.getLogger(__name__)
 ch = logging.StreamHandler()
 formatter = logging.Formatter("[%(levelname)s] %(message)s")
 
-logger.setLevel(logging.DEBUG if VERBOSE_MODE else logging.INFO)
+logger.setLevel(logging.INFO)
 ch.setFormatter(formatter)
 logger.addHandler(ch)
 
 
-class hashabledict(dict):
-    def __hash__(self) -> int:
-        return hash(frozenset(self))
+# Maximum number of calls that Gmail accepts in a single batch request
+MAX_BATCH_SIZE = 100
+# Maximum number of times a request is retried after a transient error
+MAX_RETRIES = 5
+# HTTP statuses and 403 reasons that signal a transient error worth retrying
+RETRYABLE_STATUSES = {429, 500, 503}
+RETRYABLE_REASONS = {"rateLimitExceeded", "userRateLimitExceeded"}
+# Errors raised when a request couldn't reach Gmail or its response was lost, such
+# as timeouts or dropped connections
+TRANSPORT_ERRORS = (OSError, httplib2.HttpLib2Error)
+# Maximum length of the "from" clause of a squashed filter. Gmail rejects criterias
+# longer than around 1500 characters, so some margin is kept
+MAX_CRITERIA_LENGTH = 1400
+# Seconds before their expiration at which the credentials are refreshed
+CREDS_EXPIRY_MARGIN = 60
+# Requests per second sent to Gmail, and how many can be sent at once without
+# waiting. Filter operations cost up to 5 quota units each, so this keeps the moving
+# average below Gmail's limit of 250 units per user and second. A batch larger than
+# the burst waits for its whole cost to be refilled before being sent
+RATE_LIMIT = 40
+RATE_LIMIT_BURST = 10
+# Fields of the criterias that can be squashed
+_FROM_ONLY = frozenset(("from",))
+
+# Credentials obtained during this execution
+_creds_cache: Credentials | None = None
+# Whether TOKENS_FILE must be left untouched because it contains unusable data
+_skip_token_storage = False
+
+
+class TokenBucket:
+    """Client-side rate limiter. Tokens are refilled at a constant rate up to a
+    maximum capacity, and taking more tokens than available waits until the deficit
+    is refilled.
+    """
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def take(self, n: float = 1) -> None:
+        """Take some tokens from the bucket, waiting for them if necessary.
+
+        Args:
+            n (float): How many tokens to take.
+        """
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated_at) * self.rate
+        )
+        self.updated_at = now
+        self.tokens -= n
+        if self.tokens < 0:
+            time.sleep(-self.tokens / self.rate)
+
+
+# Rate limiter shared by all the requests sent to Gmail
+_rate_limiter = TokenBucket(RATE_LIMIT, RATE_LIMIT_BURST)
+
+
+def _chunks(items: list, size: int) -> Iterator[list]:
+    """Split a list into consecutive chunks of at most `size` elements.
+
+    Args:
+        items (list): The list to split.
+        size (int): The maximum length of each chunk.
+
+    Yields:
+        list: The next chunk of the list.
+    """
+    for i in range(0, len(items), size):
+        yield items[i : i + size]
+
+
+def _expires_in(creds: Credentials) -> float:
+    """Compute how long the access token of some credentials remains usable.
+
+    Args:
+        creds (Credentials): Google credentials.
+
+    Returns:
+        float: The seconds until the access token expires.
+    """
+    if not creds.valid:
+        return 0
+    if creds.expiry is None:
+        return math.inf
+    # Google stores the expiry as a naive datetime in UTC
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    return (creds.expiry - now).total_seconds()
+
+
+def _store_tokens(creds: Credentials) -> None:
+    """Save the access and refresh tokens into TOKENS_FILE, readable only by the
+    current user. The file is replaced atomically, once the new content is on disk,
+    so that an interrupted write can't corrupt it. It's left untouched if its content
+    wouldn't change.
+
+    Args:
+        creds (Credentials): Google credentials.
+    """
+    content = creds.to_json()
+    try:
+        with open(TOKENS_FILE) as token:
+            if token.read() == content:
+                return
+    except OSError:
+        pass
+
+    tmp_file = TOKENS_FILE + ".tmp"
+    try:
+        with open(
+            os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w"
+        ) as token:
+            # A temporary file left over by a previous execution keeps its original
+            # permissions, as os.open only applies them when creating the file
+            os.chmod(tmp_file, 0o600)
+            token.write(content)
+            # Make sure the content reaches the disk before replacing the file
+            token.flush()
+            os.fsync(token.fileno())
+        os.replace(tmp_file, TOKENS_FILE)
+    except BaseException:
+        # Don't leave the tokens behind in the temporary file
+        try:
+            os.unlink(tmp_file)
+        except OSError:
+            pass
+        raise
 
 
 def get_credentials() -> Credentials:
     """Obtain credentials to login into Google. It will look for a CREDENTIALS_FILE
     file with valid credentials. Once acquired, it will generate a TOKENS_FILE file
     with access and refresh tokens, which will attempt to use on subsequent calls.
+    The credentials are also kept in memory and reused until they are about to expire.
 
     Returns:
         Credentials: Google credentials
     """
-    creds = None
+    global _creds_cache, _skip_token_storage
+
+    creds = _creds_cache
+    if creds is not None and _expires_in(creds) > CREDS_EXPIRY_MARGIN:
+        return creds
+
     scopes = ["https://www.googleapis.com/auth/gmail.settings.basic"]
-    skip_token_storage = False
 
     # The file TOKENS_FILE stores the user's access and refresh tokens, and is
     # created automatically when the authorization flow completes for the first
     # time
-    if os.path.exists(TOKENS_FILE):
+    if creds is None and os.path.exists(TOKENS_FILE):
         try:
-            creds = Credentials.from_authorized_user_file(TOKENS_FILE, scopes)
-        except (json.decoder.JSONDecodeError, ValueError):
+            with open(TOKENS_FILE, "rb") as token:
+                creds = Credentials.from_authorized_user_info(
+                    orjson.loads(token.read()), scopes
+                )
+        except (orjson.JSONDecodeError, ValueError):
             # The file exists but contains unusable credentials. We can authenticate
             # manually and avoid storing the new credentials, as that would overwrite
             # an existing file
@@ -83,141 +224,421 @@ def get_credentials() -> Credentials:
                 'To prevent this, either change the value of `TOKENS_FILE` to a non-existent file, or remove the existing file at "%s"',
                 TOKENS_FILE,
             )
-            skip_token_storage = True
+            _skip_token_storage = True
 
     # If there are no (valid) credentials available, let the user log in
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            # If there are credentials just expired, refresh them
+    if not creds or _expires_in(creds) <= CREDS_EXPIRY_MARGIN:
+        if creds and creds.refresh_token:
+            # If there are credentials expired or about to expire, refresh them
             creds.refresh(Request())
         else:
             # If there are no credentials, obtain them
             flow = InstalledAppFlow.from_client_secrets_file(CREDENTIALS_FILE, scopes)
             creds = flow.run_local_server(port=0)
 
-        if not skip_token_storage:
+        if not _skip_token_storage:
             # Save the credentials for the next run unless the file already existed, in
             # which case we prefer to avoid overwriting it
-            with open(TOKENS_FILE, "w") as token:
-                token.write(creds.to_json())
+            _store_tokens(creds)
+
+    _creds_cache = creds
     return creds
 
 
-def squash_filter(
-    service: Resource, action: dict, criterias: list[dict]
-) -> tuple[int, int]:
-    """Recieve a series of criterias that all apply the same action and attempt to
-    merge them into a single criteria.
+def _is_retryable(error: Exception, idempotent: bool = True) -> bool:
+    """Check whether an error returned by the Google API is transient, such as a
+    rate limit or a server error, and hence the request can be retried.
+
+    Args:
+        error (Exception): The error raised by the request.
+        idempotent (bool): Whether the request can be repeated without side effects.
+            A server error doesn't guarantee that the request wasn't applied, so
+            requests that aren't idempotent are only retried on rate limits.
+
+    Returns:
+        bool: True if the request can be retried.
+    """
+    if not isinstance(error, HttpError):
+        return False
+    if error.resp.status in RETRYABLE_STATUSES:
+        return idempotent or error.resp.status < 500
+    if error.resp.status == 403:
+        try:
+            reason = orjson.loads(error.content)["error"]["errors"][0]["reason"]
+        except (ValueError, KeyError, IndexError, TypeError):
+            return False
+        return reason in RETRYABLE_REASONS
+    return False
+
+
+def _retry_delay(error: Exception, attempt: int) -> float:
+    """Compute how long to wait before retrying a request. The "Retry-After" header
+    is honored when present, otherwise an exponential backoff with jitter is used.
+
+    Args:
+        error (Exception): The error raised by the request.
+        attempt (int): How many times the request has already been retried.
+
+    Returns:
+        float: The seconds to wait.
+    """
+    if isinstance(error, HttpError):
+        retry_after = error.resp.get("retry-after", "")
+        if retry_after.isdigit():
+            return float(retry_after)
+    return 2**attempt + random.uniform(0, 1)
+
+
+def _execute_with_retry(
+    request: HttpRequest | BatchHttpRequest,
+    max_retries: int = MAX_RETRIES,
+    cost: int = 1,
+    idempotent: bool = True,
+):
+    """Execute a request, retrying it with exponential backoff on transient errors.
+    Transport errors, such as timeouts, are only retried for idempotent requests, as
+    there's no way to know whether the request was applied. Every attempt is paced
+    by the rate limiter.
+
+    Args:
+        request (HttpRequest | BatchHttpRequest): The request to execute.
+        max_retries (int): Maximum number of retries before giving up.
+        cost (int): How many requests to Gmail it contains, for batch requests.
+        idempotent (bool): Whether the request can be repeated without side effects.
+
+    Returns:
+        The response of the request.
+    """
+    for attempt in range(max_retries + 1):
+        _rate_limiter.take(cost)
+        try:
+            return request.execute()
+        except HttpError as error:
+            if attempt == max_retries or not _is_retryable(error, idempotent):
+                raise
+            delay = _retry_delay(error, attempt)
+            logger.warning(
+                "Request failed with status %d, retrying in %.1f seconds...",
+                error.resp.status,
+                delay,
+            )
+            time.sleep(delay)
+        except TRANSPORT_ERRORS as error:
+            if attempt == max_retries or not idempotent:
+                raise
+            delay = _retry_delay(error, attempt)
+            logger.warning(
+                "Request failed (%s), retrying in %.1f seconds...", error, delay
+            )
+            time.sleep(delay)
+
+
+def _execute_in_batches(
+    service: Resource,
+    requests: list[tuple[str, HttpRequest]],
+    callback: Callable,
+    max_retries: int = MAX_RETRIES,
+    idempotent: bool = True,
+) -> None:
+    """Execute a series of requests grouped in as few batch requests as possible.
+    The requests that fail with a transient error are retried in a new batch.
 
     Args:
         service (Resource): A resource to interact with the Google API.
+        requests (list[tuple[str, HttpRequest]]): The requests to execute, each one
+            paired with a unique identifier that will be passed to the callback.
+        callback (Callable): Function called with the response of each request.
+        max_retries (int): Maximum number of retries before giving up.
+        idempotent (bool): Whether the requests can be repeated without side effects.
+    """
+    pending = requests
+    for attempt in range(max_retries + 1):
+        throttled = {}
+
+        def _on_response(request_id, response, exception):
+            if attempt < max_retries and _is_retryable(exception, idempotent):
+                throttled[request_id] = exception
+            else:
+                callback(request_id, response, exception)
+
+        for chunk in _chunks(pending, MAX_BATCH_SIZE):
+            batch = service.new_batch_http_request(callback=_on_response)
+            for request_id, request in chunk:
+                batch.add(request, request_id=request_id)
+            _execute_with_retry(
+                batch, max_retries, cost=len(chunk), idempotent=idempotent
+            )
+
+        if not throttled:
+            return
+
+        delay = max(_retry_delay(error, attempt) for error in throttled.values())
+        logger.warning(
+            "%d requests failed, retrying them in %.1f seconds...",
+            len(throttled),
+            delay,
+        )
+        time.sleep(delay)
+        pending = [
+            (request_id, request)
+            for request_id, request in pending
+            if request_id in throttled
+        ]
+
+
+def _pack_conditions(
+    conditions: list[str], max_len: int = MAX_CRITERIA_LENGTH
+) -> list[list[str]]:
+    """Greedily split a series of "from" clauses into groups that, once joined with
+    " OR ", fit within the given length.
+
+    Args:
+        conditions (list[str]): The list of clauses to split.
+        max_len (int): Maximum length of the joined clauses of each group.
+
+    Returns:
+        list[list[str]]: The groups of clauses.
+    """
+    packs = []
+    length = 0
+
+    for condition in conditions:
+        if packs and length + len(" OR ") + len(condition) <= max_len:
+            packs[-1].append(condition)
+            length += len(" OR ") + len(condition)
+        else:
+            packs.append([condition])
+            length = len(condition)
+
+    return packs
+
+
+def plan_squash(action: dict, criterias: list[dict]) -> list[tuple[dict, list[str]]]:
+    """Recieve a series of criterias formed by a single "from" clause that all apply
+    the same action and merge them into as few criterias as Gmail allows. No changes
+    are applied into Gmail.
+
+    Args:
         action (dict): The action of the filter.
         criterias (list[dict]): The list of criterias that share the same action.
 
     Returns:
-        tuple[int, int]: How many filters were created and how many were deleted.
+        list[tuple[dict, list[str]]]: The body of each new squashed filter and the IDs
+            of the filters it replaces.
     """
-    logger.debug("These criterias: %s", criterias)
-    logger.debug("Trigger the following action: %s", action)
-
-    conditions = []
-    original_filters = []
-    created_filters = deleted_filters = 0
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("These criterias: %s", criterias)
+        logger.debug("Trigger the following action: %s", action)
 
+    # Duplicated clauses are only included once in the new criteria, but all the
+    # filters containing them are replaced
+    filters_by_condition = {}
     for filter in criterias:
-        if list(filter["criteria"]) == ["from"]:
-            # We only want to squash those criterias formed by a single "from" clause
-            conditions += [filter["criteria"]["from"]]
-            original_filters += [filter["id"]]
-
-    if len(conditions) > 1:
-        # If there were multiple criterias formed strictly by a single "form" clause,
-        # they can be merged into a single one.
+        filters_by_condition.setdefault(filter["criteria"]["from"], []).append(
+            filter["id"]
+        )
+
+    plans = []
+
+    for conditions in _pack_conditions(list(filters_by_condition)):
+        original_filters = [
+            filter_id
+            for condition in conditions
+            for filter_id in filters_by_condition[condition]
+        ]
+        if len(original_filters) < 2:
+            # A pack holding a single filter, either because its clause is too long
+            # or because it's the leftover that didn't fit in the previous pack,
+            # would only be replaced by an identical filter, so it's left as is
+            continue
+
         new_filter = {
             "criteria": {"from": " OR ".join(conditions)},
             "action": action,
         }
-        logger.info("Creating new filter: %s", new_filter)
+        plans.append((new_filter, original_filters))
+
+    return plans
 
-        if not DEBUG:
-            # Create a new filter with the squashed criterias and the shared action
-            try:
-                results = (
-                    service.users()
-                    .settings()
-                    .filters()
-                    .create(userId="me", body=new_filter)
-                    .execute()
-                )
-            except HttpError as error:
-                logger.error(
-                    "An error occurred when creating the new filter: %s", error
-                )
-                logger.error(
-                    "Terminating the process to avoid leaving an unstable system."
-                )
-                raise
-            else:
-                logger.info("Created filter %s", results["id"])
 
-        created_filters = 1
+def apply_squashes(
+    service: Resource,
+    plans: list[tuple[dict, list[str]]],
+    debug: bool = True,
+) -> tuple[int, int]:
+    """Create the squashed filters and delete the filters they replace. All the
+    creations are sent first, and only the filters replaced by a successfully created
+    one are deleted afterwards.
+
+    Args:
+        service (Resource): A resource to interact with the Google API.
+        plans (list[tuple[dict, list[str]]]): The squashed filters to create, each one
+            paired with the IDs of the filters it replaces.
+        debug (bool): Debug mode. If True, no changes will be applied into Gmail.
 
+    Returns:
+        tuple[int, int]: How many filters were created and how many were deleted, which
+            is none in debug mode.
+    """
+    for new_filter, original_filters in plans:
+        logger.info("Creating new filter: %s", new_filter)
         for filter_id in original_filters:
-            # Delete all the filters containing the criterias that were included in the
-            # new squashed filter
             logger.info("Deleting filter %s...", filter_id)
-            if not DEBUG:
-                # Delete the filter
-                try:
-                    service.users().settings().filters().delete(
-                        userId="me", id=filter_id
-                    ).execute()
-
-                except HttpError as error:
-                    logger.error("An error occurred when deleting a filter: %s", error)
-                    logger.error(
-                        (
-                            "Bear in mind that the squashed filter has already been "
-                            "created so functionality remains the same. But you might "
-                            "want to manually delete the remaining filters."
-                        )
-                    )
-                    raise
-                else:
-                    logger.info("Deleted")
+
+    if debug:
+        # Nothing is created nor deleted in debug mode
+        return 0, 0
+
+    filters = service.users().settings().filters()
+    created_filters = deleted_filters = 0
+    delete_plan = []
+    errors = []
+
+    def _on_create(request_id, response, exception):
+        nonlocal created_filters
+        new_filter, original_filters = plans[int(request_id)]
+        if exception is not None:
+            logger.error(
+                "An error occurred when creating the new filter %s: %s",
+                new_filter,
+                exception,
+            )
+            errors.append(exception)
+        else:
+            logger.info("Created filter %s", response["id"])
+            created_filters += 1
+            # The replaced filters can only be deleted once the new one exists
+            delete_plan.extend(original_filters)
+
+    def _on_delete(request_id, response, exception):
+        nonlocal deleted_filters
+        if isinstance(exception, HttpError) and exception.resp.status == 404:
+            # The filter no longer exists, e.g. because a retried deletion had
+            # already been applied
+            logger.info("Filter %s was already deleted", request_id)
+            deleted_filters += 1
+        elif exception is not None:
+            logger.error(
+                "An error occurred when deleting filter %s: %s", request_id, exception
+            )
+            errors.append(exception)
+        else:
+            logger.info("Deleted filter %s", request_id)
             deleted_filters += 1
 
-        created_filters = 1
+    try:
+        # Create the new filters with the squashed criterias and the shared actions
+        _execute_in_batches(
+            service,
+            [
+                (str(i), filters.create(userId="me", body=new_filter, fields="id"))
+                for i, (new_filter, _) in enumerate(plans)
+            ],
+            _on_create,
+            # Retrying a creation that failed on the server side could duplicate it
+            idempotent=False,
+        )
+    except HttpError as error:
+        logger.error("An error occurred when creating the new filters: %s", error)
+        errors.append(error)
+    except TRANSPORT_ERRORS as error:
+        logger.error("An error occurred when creating the new filters: %s", error)
+        logger.error(
+            "Some of them might have been created anyway, so you might want to check "
+            "for duplicated filters."
+        )
+        errors.append(error)
 
-    else:
-        logger.debug("Filters couldn't be squashed")
+    if errors:
+        logger.error(
+            "The filters replaced by a squashed filter that couldn't be created will "
+            "be left untouched."
+        )
+
+    try:
+        # Delete all the filters containing the criterias that were included in the
+        # new squashed filters
+        _execute_in_batches(
+            service,
+            [
+                (filter_id, filters.delete(userId="me", id=filter_id))
+                for filter_id in delete_plan
+            ],
+            _on_delete,
+        )
+    except (HttpError, *TRANSPORT_ERRORS) as error:
+        logger.error("An error occurred when deleting the filters: %s", error)
+        errors.append(error)
+
+    if deleted_filters < len(delete_plan):
+        logger.error(
+            (
+                "Bear in mind that the squashed filters have already been created so "
+                "functionality remains the same. But you might want to manually "
+                "delete the remaining filters."
+            )
+        )
 
-    logger.debug("---------------")
+    if errors:
+        raise errors[0]
 
     return created_filters, deleted_filters
 
 
+def parse_args() -> argparse.Namespace:
+    """Parse the command line arguments of the script.
+
+    Returns:
+        argparse.Namespace: The parsed arguments.
+    """
+    parser = argparse.ArgumentParser(
+        description=(
+            "Merge the Gmail filters that share the same action and differ on their "
+            '"from" address.'
+        )
+    )
+    parser.add_argument(
+        "--commit",
+        action="store_true",
+        help="apply the changes into Gmail. Otherwise, runs in debug mode and only "
+        "shows what would be changed",
+    )
+    parser.add_argument(
+        "-v", "--verbose", action="store_true", help="output extra logs"
+    )
+    return parser.parse_args()
+
+
 def main():
+    args = parse_args()
+    debug = not args.commit
+
+    if args.verbose:
+        logger.setLevel(logging.DEBUG)
 
-    if DEBUG:
+    if debug:
         logger.info("RUNNING IN DEBUG MODE. NO CHANGES WILL BE APPLIED.")
 
     # Obtain Google credentials
     creds = get_credentials()
     squashed_filters = defaultdict(list)
-    created_filters = deleted_filters = 0
 
     try:
-        # Call the Gmail API to retrieve all the existing filters
         service = build("gmail", "v1", credentials=creds)
-        results = service.users().settings().filters().list(userId="me").execute()
+        # Call the Gmail API to retrieve all the existing filters
+        results = _execute_with_retry(
+            service.users()
+            .settings()
+            .filters()
+            .list(userId="me", fields="filter(id,criteria,action)")
+        )
         filters = results.get("filter", [])
     except GoogleAuthError as e:
         logger.error(
             "An error occurred when attempting to use the provided credentials: %s", e
         )
         exit(1)
-    except HttpError as e:
+    except (HttpError, *TRANSPORT_ERRORS) as e:
         logger.error(
             "An error occurred when attempting to retrieve the existing Gmail filters: %s",
             e,
@@ -231,38 +652,53 @@ def main():
     for filter in filters:
         # We want to merge all the filters according to their actions.
         # This will iterate all filters and build a dict where the action is the key
-        # and the value, a list of filters (id, criteria) with the same action
-        action = filter["action"]
-        del filter["action"]
-        squashed_filters[hashabledict(action)] += [filter]
+        # and the value, a list of filters with the same action.
+        # The action is serialized with sorted keys so that equal actions share the
+        # same key regardless of the order of their fields
+        key = orjson.dumps(filter["action"], option=orjson.OPT_SORT_KEYS)
+        squashed_filters[key].append(filter)
+    actions_by_key = {key: orjson.loads(key) for key in squashed_filters}
+
+    plans = []
+    for key, group in squashed_filters.items():
+        # We only want to squash those criterias formed by a single "from" clause
+        criterias = [
+            filter for filter in group if filter["criteria"].keys() == _FROM_ONLY
+        ]
+        if len(criterias) > 1:
+            # For each of the generated key-value pairs, we want to squash those
+            # that have more than one possible criteria (hence, a value with a
+            # length greater than 1)
+            plans.extend(plan_squash(actions_by_key[key], criterias))
+
+    if not plans:
+        logger.info("No filters to squash.")
+        if debug:
+            logger.info("RUNNING IN DEBUG MODE. NO CHANGES WERE APPLIED.")
+        return
 
     try:
-        for action in squashed_filters:
-            if len(squashed_filters[action]) > 1:
-                # For each of the generated key-value pairs, we want to squash those
-                # that have more than one possible criteria (hence, a value with a
-                # length greater than 1)
-                created, deleted = squash_filter(
-                    service, action, squashed_filters[action]
-                )
-
-                created_filters += created
-                deleted_filters += deleted
-
-    except HttpError as e:
+        created_filters, deleted_filters = apply_squashes(service, plans, debug=debug)
+    except (HttpError, *TRANSPORT_ERRORS) as e:
         logger.error("An error occurred: %s", e)
         logger.error("Terminating process.")
         exit(1)
 
     # Log the results
-    if created_filters > 0:
+    if debug:
+        logger.info(
+            "Would squash %d filters into %d new filters.",
+            sum(len(original_filters) for _, original_filters in plans),
+            len(plans),
+        )
+    elif created_filters > 0:
         logger.info(
             "Squashed %d filters into %d new filters.", deleted_filters, created_filters
         )
     else:
         logger.info("No filters were squashed.")
 
-    if DEBUG:
+    if debug:
         logger.info("RUNNING IN DEBUG MODE. NO CHANGES WERE APPLIED.")
 
 